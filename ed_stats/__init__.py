@@ -1,2 +1,2 @@
 from ed_stats.timer import MyTimer
-from ed_stats.anova import anova, factorial_anova, manova, matrix_inverse
+from ed_stats.anova import anova, factorial_anova, manova
@@ -1,97 +1,134 @@
-from numpy import trace
-from numpy.linalg import norm, pinv
-from pandas import DataFrame
+from numba import float32 as nb_float32, float64 as nb_float64, int64 as nb_int64, njit, prange
+from numba.types import Array
+from numpy import bincount, exp, float32, float64, int64, isnan, log1p, stack, zeros
+from pandas import DataFrame, factorize, isna
+from scipy.linalg import eigvals
 from scipy.stats import f
 from sklearn.decomposition import PCA
 
+# Minimum number of values (rows * dependent variables) for which the ANOVA columns are processed in parallel
+PARALLEL_MIN_SIZE = 1000000
 
-def weighted_sum(func_data):
+
+def _kernel_signatures(n_dims):
     """
-    Return the mean of a series multiplied by the number of items in the series.
-    Used to calculate an ANOVA for datasets with different ns for each independent variable group.
-    :param func_data: (pandas Series) input data
-    :return: float
+    Numba signatures of the ANOVA kernels for float32 (factorial_anova's PCA factors) and float64 values.
+    The values are typed readonly, which also accepts writable arrays, because pandas can hand out readonly
+    views of a frame's data and the kernels never write to them.
+    :param n_dims: (int) number of dimensions of the values array
+    :return: list of numba argument type tuples
     """
-    return func_data.mean() * func_data.count()
+    return [(Array(dtype, n_dims, 'A', readonly=True), nb_int64[:], nb_int64) for dtype in (nb_float32, nb_float64)]
 
 
-def matrix_inverse(func_data):
+# Compiled eagerly for every signature and cached to disk, so no call triggers a recompilation after the first import
+@njit(_kernel_signatures(1), cache=True)
+def _anova_kernel(values, group_ids, n_groups):
     """
-    Return the matrix inverse of an input dataframe
-    Used to calculate some of the statistical tests for the MANOVA
-    :param func_data: (pandas DataFrame) dataframe to be inverted
-    :return: the inverse matrix as a dataframe
+    Single pass accumulation of the size, mean and sum of squared deviations of each group in values.
+    Uses Welford's algorithm, so the sums of squares stay accurate for data with a large mean.
+    The statistics are always accumulated in float64, whatever the precision of values.
+    Missing values, and values with a negative (missing) group code, are skipped.
+    :param values: (numpy array) float32 or float64 values of the dependent variable
+    :param group_ids: (numpy array) integer code in [0, n_groups) of the group each value belongs to, or -1
+    :param n_groups: (int) number of distinct groups
+    :return: tuple of numpy arrays (counts, means, sum_squares), each of length n_groups
     """
-    return DataFrame(pinv(func_data.values.astype(float)), func_data.columns, func_data.index)
+    counts = zeros(n_groups, dtype=int64)
+    means = zeros(n_groups, dtype=float64)
+    sum_squares = zeros(n_groups, dtype=float64)
 
+    for i in range(values.shape[0]):
+        group = group_ids[i]
+        if group < 0 or isnan(values[i]):
+            continue
 
-def anova(input_data, group_column, columns=None):
+        delta = values[i] - means[group]
+        counts[group] += 1
+        means[group] += delta / counts[group]
+        sum_squares[group] += delta * (values[i] - means[group])
+
+    return counts, means, sum_squares
+
+
+@njit(_kernel_signatures(2), parallel=True, cache=True)
+def _anova_kernel_parallel(values_matrix, group_ids, n_groups):
     """
-    Calculate a one way ANOVA of the effect of the group column for each of the dependent variables in columns
-    :param group_column: (str, int, pandas column object) Specifies the independent variable column
-    :param columns: (list) List of the dependent variables to analyze the effect of the independent variable on.
-    If none, function uses all columns in the input besides the group column as dependent variables.
-    :return: pandas DataFrame containing the F-scores and p value for the test of each dependent variable.
+    Run _anova_kernel over every column of values_matrix, spreading the columns across numba's threads.
+    The number of threads can be tuned with numba.set_num_threads.
+    :param values_matrix: (numpy array) (n_samples, n_variables) float matrix of the dependent variables
+    :param group_ids: (numpy array) integer code in [0, n_groups) of the group of each row, or -1 if it is missing
+    :param n_groups: (int) number of distinct groups
+    :return: tuple of numpy arrays (counts, means, sum_squares), each of shape (n_groups, n_variables)
     """
-    if len(columns) > 0:
-        pass
-    else:
-        columns = input_data.drop(labels=[group_column], axis=1).columns
+    counts = zeros((n_groups, values_matrix.shape[1]), dtype=int64)
+    means = zeros((n_groups, values_matrix.shape[1]), dtype=float64)
+    sum_squares = zeros((n_groups, values_matrix.shape[1]), dtype=float64)
 
-    # for var_column in columns:
-    #     input_data.loc[:, var_column] = input_data.loc[:, var_column].astype(float)
-    input_data.loc[:, group_column] = input_data.loc[:, group_column].astype(float)
+    for i in prange(values_matrix.shape[1]):
+        column_counts, column_means, column_sum_squares = _anova_kernel(values_matrix[:, i], group_ids, n_groups)
+        counts[:, i] = column_counts
+        means[:, i] = column_means
+        sum_squares[:, i] = column_sum_squares
 
-    result = DataFrame(data=None, index=columns,
-                       columns=['p_value', 'f_statistic', 'mean_variance_between', 'mean_variance_within', ])
+    return counts, means, sum_squares
 
-    for dep_variable in columns:
-        data = input_data.dropna(axis=0, how='any', subset=[dep_variable])
-        data.loc[:, dep_variable] = data.loc[:, dep_variable].astype(float)
-        n_groups = data.loc[:, group_column].unique().shape[0]
-        total_n = data.loc[:, dep_variable].count()
 
-        df1 = n_groups - 1
-        df2 = total_n - n_groups
+def _anova_core(values_matrix, group_ids, n_groups):
+    """
+    Calculate one way ANOVAs for every column of values_matrix, shared by anova and factorial_anova
+    :param values_matrix: (numpy array) (n_samples, n_variables) float matrix of the dependent variables
+    :param group_ids: (numpy array) integer code in [0, n_groups) of the group of each row, or -1 if it is missing
+    :param n_groups: (int) number of distinct groups
+    :return: tuple of numpy arrays (f_statistic, p_value, ms_between, ms_within), each of length n_variables
+    """
+    # (n_groups, n_variables) matrices of the per group statistics.
+    # Missing values are skipped inside the kernel, so no per variable copy of the data is needed
+    if values_matrix.shape[1] > 1 and values_matrix.size >= PARALLEL_MIN_SIZE:
+        counts, means, sum_squares = _anova_kernel_parallel(values_matrix, group_ids, n_groups)
+    else:
+        # Threading overhead isn't worth it for small inputs
+        counts = zeros((n_groups, values_matrix.shape[1]), dtype=int64)
+        means = zeros((n_groups, values_matrix.shape[1]), dtype=float64)
+        sum_squares = zeros((n_groups, values_matrix.shape[1]), dtype=float64)
 
-        grand_mean = sum(data.groupby(group_column)[dep_variable].agg(weighted_sum)) / total_n
+        for i in range(values_matrix.shape[1]):
+            counts[:, i], means[:, i], sum_squares[:, i] = _anova_kernel(values_matrix[:, i], group_ids, n_groups)
 
-        # Calculate the amount of variance between different sub groups
-        ss_between = sum(
-            data.groupby(group_column).count()[dep_variable] * (
-                data.groupby(group_column).mean()[dep_variable] - grand_mean
-            ) ** 2)
+    # Groups without any observations of a variable don't count towards its degrees of freedom
+    observed_groups = (counts > 0).sum(axis=0)
+    total_n = counts.sum(axis=0)
 
-        # Calculate the amount of variance within different sub groups
-        ss_within = df2 * data.groupby(group_column).var()[dep_variable].sum()
+    df1 = observed_groups - 1
+    df2 = total_n - observed_groups
 
-        # Get the weighted mean variance by dividing by the degrees of freedom
-        ms_between = ss_between / df1
-        ms_within = ss_within / df2
+    grand_mean = (counts * means).sum(axis=0) / total_n
 
-        # Calculate the f statistic for this hypothesis
-        f_statistic = ms_between / ms_within
+    # Calculate the amount of variance between different sub groups
+    ss_between = (counts * (means - grand_mean) ** 2).sum(axis=0)
 
-        # Calculate the p_value given the F statistic
+    # Calculate the amount of variance within different sub groups
+    ss_within = sum_squares.sum(axis=0)
 
-        p_value = f.sf(f_statistic, df1, df2)
+    # Get the weighted mean variance by dividing by the degrees of freedom
+    ms_between = ss_between / df1
+    ms_within = ss_within / df2
 
-        result.loc[dep_variable, 'mean_variance_between'] = ms_between
-        result.loc[dep_variable, 'mean_variance_within'] = ms_within
-        result.loc[dep_variable, 'f_statistic'] = f_statistic
-        result.loc[dep_variable, 'p_value'] = p_value
+    # Calculate the f statistic for this hypothesis
+    f_statistic = ms_between / ms_within
 
-    return result
+    # Calculate the p_value given the F statistic
+    p_value = f.sf(f_statistic, df1, df2)
 
+    return f_statistic, p_value, ms_between, ms_within
 
-def factorial_anova(input_data, group_column, columns=None, n_factors=3):
+
+def anova(input_data, group_column, columns=None):
     """
-    Perform a PCA of the data columns given by columns, then calculate an Anova on the reduced variables
-    :param input_data: (pandas DataFrame) Input data object to be analyzed
+    Calculate a one way ANOVA of the effect of the group column for each of the dependent variables in columns
     :param group_column: (str, int, pandas column object) Specifies the independent variable column
     :param columns: (list) List of the dependent variables to analyze the effect of the independent variable on.
-                    If none, function uses all columns in the input besides the group column as dependent variables.
-    :param n_factors: (int) Number of
+    If none, function uses all columns in the input besides the group column as dependent variables.
     :return: pandas DataFrame containing the F-scores and p value for the test of each dependent variable.
     """
     if len(columns) > 0:
@@ -99,58 +136,55 @@ def factorial_anova(input_data, group_column, columns=None, n_factors=3):
     else:
         columns = input_data.drop(labels=[group_column], axis=1).columns
 
-    # for var_column in columns:
-    #     input_data.loc[:, var_column] = input_data.loc[:, var_column].astype(float)
-
-    input_data.loc[:, group_column] = input_data.loc[:, group_column].astype(float)
-
-    pca = PCA(n_factors)
-    factor_data = pca.fit_transform(input_data.loc[:, columns])
-    factor_data = DataFrame(factor_data)
+    # Integer codes of the groups, computed once and shared by every dependent variable
+    group_ids, group_labels = factorize(input_data.loc[:, group_column].to_numpy(), sort=False)
+    n_labels = group_labels.size
 
-    factors = factor_data.columns
-
-    factor_data.loc[:, group_column] = input_data.loc[:, group_column]
-
-    result = DataFrame(data=None, index=factors,
-                       columns=['p_value', 'f_statistic', 'mean_variance_between', 'mean_variance_within', ])
+    # Convert the dependent variables to a single float matrix once, rather than column by column
+    values_matrix = input_data.loc[:, columns].to_numpy(dtype=float64)
 
-    input_data = factor_data
-    for dep_variable in factors:
-        data = input_data.dropna(axis=0, how='any', subset=[dep_variable])
-        data.loc[:, dep_variable] = data.loc[:, dep_variable].astype(float)
-        n_groups = data.loc[:, group_column].unique().shape[0]
-        total_n = data.loc[:, dep_variable].count()
+    f_statistic, p_value, ms_between, ms_within = _anova_core(values_matrix, group_ids, n_labels)
 
-        df1 = n_groups - 1
-        df2 = total_n - n_groups
+    result = DataFrame({'p_value': p_value, 'f_statistic': f_statistic,
+                        'mean_variance_between': ms_between, 'mean_variance_within': ms_within},
+                       index=columns, dtype=float64)
 
-        grand_mean = sum(data.groupby(group_column)[dep_variable].agg(weighted_sum)) / total_n
+    return result
 
-        # Calculate the amount of variance between different sub groups
-        ss_between = sum(
-            data.groupby(group_column).count()[dep_variable] * (
-                data.groupby(group_column).mean()[dep_variable] - grand_mean
-            ) ** 2)
 
-        # Calculate the amount of variance within different sub groups
-        ss_within = df2 * data.groupby(group_column).var()[dep_variable].sum()
+def factorial_anova(input_data, group_column, columns=None, n_factors=3):
+    """
+    Perform a PCA of the data columns given by columns, then calculate an Anova on the reduced variables
+    :param input_data: (pandas DataFrame) Input data object to be analyzed
+    :param group_column: (str, int, pandas column object) Specifies the independent variable column
+    :param columns: (list) List of the dependent variables to analyze the effect of the independent variable on.
+                    If none, function uses all columns in the input besides the group column as dependent variables.
+    :param n_factors: (int) Number of principal components to reduce the dependent variables to
+    :return: pandas DataFrame containing the F-scores and p value for the test of each dependent variable.
+    """
+    if len(columns) > 0:
+        pass
+    else:
+        columns = input_data.drop(labels=[group_column], axis=1).columns
 
-        # Get the weighted mean variance by dividing by the degrees of freedom
-        ms_between = ss_between / df1
-        ms_within = ss_within / df2
+    # Single precision is plenty for the factor scores and halves the memory traffic of the SVD.
+    # The data is centred in float64 first, so a large mean doesn't swamp the float32 precision.
+    # The randomized solver only computes the n_factors leading components, seeded so results are repeatable.
+    values_matrix = input_data.loc[:, columns].to_numpy(dtype=float64)
+    pca = PCA(n_components=n_factors, svd_solver='randomized', random_state=0)
+    factor_data = pca.fit_transform((values_matrix - values_matrix.mean(axis=0)).astype(float32))
 
-        # Calculate the f statistic for this hypothesis
-        f_statistic = ms_between / ms_within
+    factors = range(factor_data.shape[1])
 
-        # Calculate the p_value given the F statistic
+    # The PCA keeps the row order of the input, so the group codes line up with the factor rows
+    group_ids, group_labels = factorize(input_data.loc[:, group_column].to_numpy(), sort=False)
+    n_labels = group_labels.size
 
-        p_value = f.sf(f_statistic, df1, df2)
+    f_statistic, p_value, ms_between, ms_within = _anova_core(factor_data, group_ids, n_labels)
 
-        result.loc[dep_variable, 'mean_variance_between'] = ms_between
-        result.loc[dep_variable, 'mean_variance_within'] = ms_within
-        result.loc[dep_variable, 'f_statistic'] = f_statistic
-        result.loc[dep_variable, 'p_value'] = p_value
+    result = DataFrame({'p_value': p_value, 'f_statistic': f_statistic,
+                        'mean_variance_between': ms_between, 'mean_variance_within': ms_within},
+                       index=factors, dtype=float64)
 
     return result
 
@@ -175,167 +209,52 @@ def manova(input_data, group_column, columns=None):
     result = DataFrame(data=None, index=columns,
                        columns=['p_value', 'f_statistic', 'mean_variance_between', 'mean_variance_within', ])
 
-    data = input_data
-    for var_column in columns:
-        data.loc[:, var_column] = data.loc[:, var_column].astype(float)
-    data.loc[:, group_column] = data.loc[:, group_column].astype(float)
-    n_groups = data.loc[:, group_column].unique().shape[0]
+    labels = input_data.loc[:, group_column].to_numpy()
+    values_matrix = input_data.loc[:, columns].to_numpy(dtype=float64)
+
+    # Listwise deletion, rows missing the group or any dependent variable are left out of the MANOVA
+    keep = ~isna(labels) & ~isnan(values_matrix).any(axis=1)
+    values_matrix = values_matrix[keep]
 
-    total_n = data.loc[:, columns[0]].count()
+    # Factorize after the deletion, so groups without any complete rows don't count towards n_groups
+    group_ids, group_labels = factorize(labels[keep], sort=False)
+    n_groups = group_labels.size
 
-    n_vector = data.groupby(group_column)[columns[0]].count()
+    total_n = values_matrix.shape[0]
+
+    n_vector = bincount(group_ids, minlength=n_groups)
 
     df1 = n_groups - 1
     df2 = total_n - n_groups
 
-    grand_mean_vector = (data.groupby(group_column)[columns].agg(weighted_sum)).sum() / total_n
+    # (n_groups, n_variables) matrix of the sum of each variable within each group
+    group_sums = stack([bincount(group_ids, weights=values_matrix[:, i], minlength=n_groups)
+                        for i in range(values_matrix.shape[1])], axis=1)
 
-    sample_mean_matrix = DataFrame(data=None, index=data.loc[:, group_column].unique(), columns=columns)
+    grand_mean_vector = group_sums.sum(axis=0) / total_n
 
-    for dependent_variable in columns:
-        sample_mean_matrix.loc[:, dependent_variable] = data.groupby(group_column)[dependent_variable].mean()
+    sample_mean_matrix = group_sums / n_vector[:, None]
 
-    total_variance = data.loc[:, columns].cov() * (total_n - 1)
+    # Sums of squares and cross products, computed as matrix products of the deviations from the mean
+    centered_values = values_matrix - grand_mean_vector
+    total_variance = centered_values.T @ centered_values
 
-    hypothesis_variance = ((sample_mean_matrix - grand_mean_vector).T * (n_vector)).dot(
-        (sample_mean_matrix - grand_mean_vector))
+    mean_deviations = sample_mean_matrix - grand_mean_vector
+    hypothesis_variance = (mean_deviations * n_vector[:, None]).T @ mean_deviations
 
     error_variance = total_variance - hypothesis_variance
 
-    wilks_lambda = norm(error_variance.values) / norm(total_variance.values)
+    # All three statistics are functions of the eigenvalues of inv(E) H, so solve the generalized
+    # eigenvalue problem H v = lambda E v once instead of inverting E and E + H separately
+    eigenvalues = eigvals(hypothesis_variance, error_variance).real
+
+    wilks_lambda = exp(-log1p(eigenvalues).sum())
 
-    hotelling_lawley_trace = trace(hypothesis_variance.dot(matrix_inverse(error_variance)))
+    hotelling_lawley_trace = eigenvalues.sum()
 
-    phillai_bartlett_trace = trace(hypothesis_variance.dot(
-        matrix_inverse(hypothesis_variance + error_variance)
-    ))
+    phillai_bartlett_trace = (eigenvalues / (1 + eigenvalues)).sum()
 
     result = DataFrame([wilks_lambda, hotelling_lawley_trace, phillai_bartlett_trace])
     result.loc[:, 'labels'] = ["wilks_lambda", "hotelling_lawley_trace", "phillai_bartlett_trace"]
 
     return result
-
-# class AnovaDataFrame(DataFrame):
-#     """
-#     Subclass of pandas DataFrame implementing ANOVA methods
-#     """
-#
-#     def inverse(self):
-#         return matrix_inverse(self)
-#
-#     def anova(self, group_column, columns=None):
-#         """
-#         Calculate a one way ANOVA of the effect of the group column for each of the dependent variables in columns
-#         :param group_column: (str, int, pandas column object) Specifies the independent variable column
-#         :param columns: (list) List of the dependent variables to analyze the effect of the independent variable on.
-#         If none, function uses all columns in the input besides the group column as dependent variables.
-#         :return: pandas DataFrame containing the F-scores and p value for the test of each dependent variable.
-#         """
-#         if columns:
-#             pass
-#         else:
-#             columns = self.drop(labels=[group_column], axis=1).columns
-#
-#         for var_column in columns:
-#             self.loc[:, var_column] = self.loc[:, var_column].astype(float)
-#         self.loc[:, group_column] = self.loc[:, group_column].astype(float)
-#
-#
-#         result = DataFrame(data=None, index=columns,
-#                            columns=['p_value', 'f_statistic', 'mean_variance_between', 'mean_variance_within', ])
-#
-#         for dep_variable in columns:
-#             data = self.dropna(axis=0, how='any', subset=[dep_variable])
-#             data.loc[:, dep_variable] = data.loc[:, dep_variable].astype(float)
-#             n_groups = data.loc[:, group_column].unique().shape[0]
-#             total_n = data.loc[:, dep_variable].count()
-#
-#             df1 = n_groups - 1
-#             df2 = total_n - n_groups
-#
-#             grand_mean = sum(data.groupby(group_column)[dep_variable].agg(weighted_sum)) / total_n
-#
-#             # Calculate the amount of variance between different sub groups
-#             ss_between = sum(
-#                 data.groupby(group_column).count()[dep_variable] * (
-#                     data.groupby(group_column).mean()[dep_variable] - grand_mean
-#                 ) ** 2)
-#
-#             # Calculate the amount of variance within different sub groups
-#             ss_within = df2 * data.groupby(group_column).var()[dep_variable].sum()
-#
-#             # Get the weighted mean variance by dividing by the degrees of freedom
-#             ms_between = ss_between / df1
-#             ms_within = ss_within / df2
-#
-#             # Calculate the f statistic for this hypothesis
-#             f_statistic = ms_between / ms_within
-#
-#             # Calculate the p_value given the F statistic
-#
-#             p_value = f.sf(f_statistic, df1, df2)
-#
-#             result.loc[dep_variable, 'mean_variance_between'] = ms_between
-#             result.loc[dep_variable, 'mean_variance_within'] = ms_within
-#             result.loc[dep_variable, 'f_statistic'] = f_statistic
-#             result.loc[dep_variable, 'p_value'] = p_value
-#
-#         return result
-#
-#     def manova(self, group_column, columns=None):
-#         """
-#         Calculate a MANOVA
-#         :param group_column: (str, int, pandas column object) Specifies the independent variable column
-#         :param columns: (list) List of the dependent variables to analyze the effect of the independent variable on.
-#         If none, function uses all columns in the input besides the group column as dependent variables.
-#         :return: pandas DataFrame containing the F-scores and p value for the test of each dependent variable.
-#         """
-#         if columns:
-#             pass
-#         else:
-#             columns = self.drop(labels=[group_column], axis=1).columns
-#
-#         result = DataFrame(data=None, index=columns,
-#                            columns=['p_value', 'f_statistic', 'mean_variance_between', 'mean_variance_within', ])
-#
-#         data = self
-#         for var_column in columns:
-#             data.loc[:, var_column] = data.loc[:, var_column].astype(float)
-#         data.loc[:, group_column] = data.loc[:, group_column].astype(float)
-#         n_groups = data.loc[:, group_column].unique().shape[0]
-#
-#         total_n = data.loc[:, columns[0]].count()
-#
-#         n_vector = data.groupby(group_column)[columns[0]].count()
-#
-#         df1 = n_groups - 1
-#         df2 = total_n - n_groups
-#
-#         grand_mean_vector = (data.groupby(group_column)[columns].agg(weighted_sum)).sum() / total_n
-#
-#         sample_mean_matrix = DataFrame(data=None, index=data.loc[:, group_column].unique(), columns=columns)
-#
-#         for dependent_variable in columns:
-#             sample_mean_matrix.loc[:, dependent_variable] = data.groupby(group_column)[dependent_variable].mean()
-#
-#         total_variance = data.loc[:, columns].cov() * (total_n - 1)
-#
-#         hypothesis_variance = ((sample_mean_matrix - grand_mean_vector).T*(n_vector)).dot(
-#             (sample_mean_matrix - grand_mean_vector))
-#
-#         error_variance = total_variance - hypothesis_variance
-#
-#         wilks_lambda = norm(error_variance.values)/norm(total_variance.values)
-#
-#         hotelling_lawley_trace = trace(hypothesis_variance.dot(matrix_inverse(error_variance)))
-#
-#         phillai_bartlett_trace = trace(hypothesis_variance.dot(
-#             matrix_inverse(hypothesis_variance + error_variance)
-#         ))
-#
-#         result = DataFrame([wilks_lambda, hotelling_lawley_trace, phillai_bartlett_trace])
-#         result.loc[:, 'labels'] = ["wilks_lambda", "hotelling_lawley_trace", "phillai_bartlett_trace"]
-#
-#         return result
-#
-#     pass
@@ -9,6 +9,6 @@ setup(
     author_email='EdMan1022@gmail.com',
     license='MIT',
     packages=['ed_stats'],
-    install_requires=['pandas', 'scipy', 'scikit-learn', 'numpy'],
+    install_requires=['pandas', 'scipy', 'scikit-learn', 'numpy', 'numba'],
     python_requires='>=3',
     zip_safe=False)